@@ -1,147 +1,554 @@
 import streamlit as st
+from streamlit.errors import StreamlitAPIException
+import jsonschema
+import hashlib
 import openai
-import json
+import orjson
 import os
+import random
+import re
 import textwrap
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from typing import List, Dict
 
+try:
+    import tiktoken
+except ImportError:  # optional: only used for token counts
+    tiktoken = None
+
 st.set_page_config(page_title="ACOTAR-style Interactive Novel", layout="wide")
 
 ####################
 # Helper utilities #
 ####################
+PC_SHARDS = ("pc_stats", "pc_relationships", "pc_inventory")
+HISTORY_PROMPT_ENTRIES = 6  # history lines sent to the LLM each turn
+HISTORY_VIEW_ENTRIES = 10  # scenes shown in the history expander
+MODEL_OPTIONS = ["gpt-4o-mini", "gpt-4o", "gpt-4o-mid"]
+PREFETCH_TOP_N = 2  # choices per scene whose next scene is requested speculatively
+PREFETCH_WORKERS = 3  # concurrent prefetch requests, shared by all sessions
+
 def init_session_state():
     if "openai_api_key" not in st.session_state:
         st.session_state.openai_api_key = ""
-    if "pc" not in st.session_state:
-        st.session_state.pc = None  # player character dict
+    # Player character, split by kind so an update only re-serializes the shard it touched
+    if "pc_stats" not in st.session_state:
+        st.session_state.pc_stats = None  # flat scalars (name, court, hp, ...); None until created
+    if "pc_relationships" not in st.session_state:
+        st.session_state.pc_relationships = {}  # npc name -> value
+    if "pc_inventory" not in st.session_state:
+        st.session_state.pc_inventory = []
     if "story_history" not in st.session_state:
-        st.session_state.story_history = []  # list of dicts {narrative, choice_text, raw_llm}
+        st.session_state.story_history = deque()  # dicts {scene_id, narrative, choices, choice_taken[, raw_llm]}
+    if "recent_history" not in st.session_state:
+        st.session_state.recent_history = deque(maxlen=HISTORY_VIEW_ENTRIES)  # rolling view for the expander
+    if "export_blob" not in st.session_state:
+        st.session_state.export_blob = bytearray(b"[]")  # story_history as a JSON array, appended per scene
+    if "export_version" not in st.session_state:
+        st.session_state.export_version = 0  # bumped with every change to export_blob
+    if "export_cache" not in st.session_state:
+        st.session_state.export_cache = None  # ((export_version, pc_version), export bytes)
+    if "history_block_cache" not in st.session_state:
+        st.session_state.history_block_cache = deque(maxlen=HISTORY_PROMPT_ENTRIES)  # preformatted prompt lines
     if "current_scene" not in st.session_state:
         st.session_state.current_scene = None
-    if "model" not in st.session_state:
-        st.session_state.model = "gpt-4o-mini"  # change if needed
+    if "model_quality" not in st.session_state:
+        st.session_state.model_quality = "gpt-4o-mini"  # story turns; change if needed
+    if "model_fast" not in st.session_state:
+        st.session_state.model_fast = "gpt-4o-mini"  # low-stakes calls such as the opening scene
     if "temperature" not in st.session_state:
         st.session_state.temperature = 0.8
     if "max_tokens" not in st.session_state:
         st.session_state.max_tokens = 500
+    if "prefetch_enabled" not in st.session_state:
+        st.session_state.prefetch_enabled = False  # opt-in: up to PREFETCH_TOP_N extra API calls per scene
+    if "prefetch" not in st.session_state:
+        st.session_state.prefetch = {}  # request key -> Future[str] of raw LLM text for the current scene
+    if "debug_raw" not in st.session_state:
+        st.session_state.debug_raw = False  # keep full raw LLM text in history entries
+    if "pc_version" not in st.session_state:
+        st.session_state.pc_version = 0  # bumped whenever any pc shard is mutated
+    if "pc_shard_versions" not in st.session_state:
+        st.session_state.pc_shard_versions = {shard: 0 for shard in PC_SHARDS}  # pc_version of each shard's last change
+    if "pc_json_cache" not in st.session_state:
+        st.session_state.pc_json_cache = {}  # shard -> (version, json)
 
 def pretty_json(d):
-    return json.dumps(d, indent=2, ensure_ascii=False)
+    return orjson.dumps(d, option=orjson.OPT_INDENT_2).decode()
+
+def snippet(text: str, limit: int = 200):
+    text = text or ""
+    return text if len(text) <= limit else text[:limit - 1].rstrip() + "…"
+
+def mark_pc_dirty(*shards: str):
+    st.session_state.pc_version += 1
+    for shard in shards:
+        st.session_state.pc_shard_versions[shard] = st.session_state.pc_version
+
+def pc_shard_json(shard: str):
+    # Only a shard mutated since its last serialization is dumped again; clean shards come from the memo.
+    # (Kept in session_state rather than an lru_cache: the latter is shared by every session in the process.)
+    version = st.session_state.pc_shard_versions[shard]
+    cached = st.session_state.pc_json_cache.get(shard)
+    if cached is None or cached[0] != version:
+        cached = (version, orjson.dumps(st.session_state[shard]).decode())
+        st.session_state.pc_json_cache[shard] = cached
+    return cached[1]
+
+def pc_view():
+    """The player as one nested dict (for display and export)."""
+    return {
+        **st.session_state.pc_stats,
+        "relationship": st.session_state.pc_relationships,
+        "inventory": st.session_state.pc_inventory,
+    }
+
+def _is_number(v):
+    # Exact type checks: faster than isinstance and keep bools from being summed as 1/0.
+    return type(v) is int or type(v) is float
+
+def _add_or_set(current, v):
+    # A number is a delta only on top of a number; anything else overwrites.
+    return current + v if _is_number(v) and _is_number(current) else v
+
+def apply_state_updates(updates: Dict):
+    """Apply an LLM turn's state_updates to the pc shards. Returns True if anything changed."""
+    stats = st.session_state.pc_stats
+    relationships = st.session_state.pc_relationships
+    inventory = st.session_state.pc_inventory
+    dirty = set()
+    plain = {}
+    try:
+        for k, v in updates.items():
+            if k == "inventory":
+                # a list of names replaces the inventory, a single name is picked up; other shapes are ignored
+                if type(v) is list:
+                    inventory[:] = [item for item in v if type(item) is str]
+                elif type(v) is str:
+                    inventory.append(v)
+                else:
+                    continue
+                dirty.add("pc_inventory")
+            elif k == "relationship" and type(v) is dict:
+                relationships.update(v)
+                dirty.add("pc_relationships")
+            elif k.startswith("relationship_with_"):
+                npc = k[len("relationship_with_"):]
+                relationships[npc] = _add_or_set(relationships.get(npc, 0), v)
+                dirty.add("pc_relationships")
+            else:
+                plain[k] = v
+        if plain:
+            nums = {k: v for k, v in plain.items() if _is_number(v) and _is_number(stats.get(k, 0))}
+            stats.update({k: stats.get(k, 0) + v for k, v in nums.items()})
+            stats.update({k: v for k, v in plain.items() if k not in nums})
+            dirty.add("pc_stats")
+    finally:
+        # Even on an unexpected failure, shards already mutated must not keep serving stale memoized JSON.
+        if dirty:
+            mark_pc_dirty(*dirty)
+    return bool(dirty)
+
+def push_history(entry: Dict):
+    """Append a scene to the story, make it current, and add its prompt line to the rolling summary."""
+    history = st.session_state.story_history
+    history.append(entry)
+    st.session_state.recent_history.append(entry)
+    # Formatted once here; later turns reuse the line instead of rebuilding the summary.
+    st.session_state.history_block_cache.append(
+        f"{len(history)}. Scene {entry.get('scene_id')}: {snippet(entry.get('narrative'))}\n   Choice: {entry.get('choice_taken', '')}"
+    )
+    # Serialize only the new entry: reopen the array by replacing its closing "]".
+    blob = st.session_state.export_blob
+    blob[-1:] = (b"," if len(blob) > 2 else b"") + orjson.dumps(entry) + b"]"
+    st.session_state.export_version += 1
+    st.session_state.current_scene = entry
+    clear_prefetch()
+
+def reset_history():
+    st.session_state.story_history = deque()
+    st.session_state.recent_history.clear()
+    st.session_state.history_block_cache.clear()
+    st.session_state.export_blob = bytearray(b"[]")
+    st.session_state.export_version += 1
+    st.session_state.export_cache = None
+    st.session_state.current_scene = None
+    clear_prefetch()
+
+def export_json():
+    """The story export as bytes, rebuilt only when the history or the player changed."""
+    key = (st.session_state.export_version, st.session_state.pc_version)
+    cached = st.session_state.export_cache
+    if cached is None or cached[0] != key:
+        data = b'{"player":' + orjson.dumps(pc_view()) + b',"history":' + st.session_state.export_blob + b"}"
+        cached = (key, bytes(data))
+        st.session_state.export_cache = cached
+    return cached[1]
+
+def make_history_entry(parsed: Dict, choice_text: str, raw: str):
+    entry = {
+        "scene_id": parsed.get("scene_id"),
+        "narrative": parsed.get("narrative"),
+        "choices": parsed.get("choices"),
+        "choice_taken": choice_text,
+    }
+    if st.session_state.debug_raw:
+        entry["raw_llm"] = raw
+    return entry
 
 ###############
 # Prompts     #
 ###############
+# Kept short: details of the response shape live in DM_RESPONSE_SCHEMA; rule 1 names the keys for
+# models that are not sent the schema.
 DM_SYSTEM_PROMPT = textwrap.dedent("""
-You are the Dungeon Master / Narrative Engine for an original, fan-inspired interactive novel set in a romantic high-fantasy fae world. 
-DO NOT reference your system role or the model. The PLAYER should never see technical details or API text.
-
+You are the narrator of an original, fan-inspired interactive novel in a romantic high-fantasy fae world. Never mention your role, the model, or technical details.
 Rules:
-1. Write evocative, novel-style narrative in the voice of lush romantic fantasy (no direct quotes from existing copyrighted novels).
-2. Each response must be valid JSON (no extra text). The JSON object must contain exactly these keys:
-   - "narrative": a string paragraph (2-6 sentences) continuing the story.
-   - "choices": an array of 3 to 5 strings; short, distinct options the player can click next.
-   - "state_updates": an object with any small changes to the player state (e.g., {"relationship_with_Rhys": 1, "hp": -1}) — can be empty.
-   - "scene_id": a short identifier for the scene.
-3. After the JSON object, nothing else should be output.
-4. If the player's input is a free-text custom action (not one of the choices), interpret it plausibly in-world, then generate the next scene normally and populate narrative/choices/state_updates.
-5. Keep choices consequential and clearly different (avoid duplicates).
-6. Always assume the player character is present and make scenes appropriate for a mid-tier powerful protagonist (not an invincible god).
-7. If the story risks large-scale violence or sexual content, keep it brief and non-graphic; do not produce explicit sexual content.
-8. Maintain continuity based on the 'player_state' and 'history' provided in the messages.
-9. Use short scene_id strings, e.g., "mansion_hall_01".
+1. Reply with only a JSON object: "narrative" (2-6 sentences), "choices" (3-5 strings), "state_updates" (object, may be empty), "scene_id".
+2. Lush, evocative romantic-fantasy prose; never quote existing novels.
+3. Choices are consequential and clearly different.
+4. The protagonist is always present: capable, not invincible.
+5. Violence brief and non-graphic; no explicit sexual content.
+6. Keep continuity with the player state and history.
+7. Short scene_id, e.g. "mansion_hall_01".
 """).strip()
 
-def build_messages(pc: Dict, history: List[Dict], player_input: str, is_custom: bool):
-    """
-    Build Chat API messages with:
-    - system: DM_SYSTEM_PROMPT
-    - user: current context including pc & history & player input
-    """
-    # Build a compact history summary to pass to LLM (last ~6 entries)
-    hist_excerpt = history[-6:]
-    summary_lines = []
-    for i, h in enumerate(hist_excerpt, 1):
-        entry = h.get("narrative", "")
-        chosen = h.get("choice_taken", "")
-        summary_lines.append(f"{i}. Scene: {entry}\n   Choice: {chosen}")
-    history_block = "\n".join(summary_lines) if summary_lines else "None yet."
-
-    player_state_block = json.dumps(pc, ensure_ascii=False)
+# Identical on every turn, so the system + instruction prefix stays stable for server-side prompt caching.
+INSTRUCTION_MESSAGE = textwrap.dedent("""
+The next message holds the player character, recent history, and the player's latest input.
+If the input matches one of the previous choices, continue that branch. Otherwise it is a free-text custom action: interpret it plausibly in-world, then continue the scene.
+""").strip()
 
-    user_instructions = textwrap.dedent(f"""
-    Player character (JSON): {player_state_block}
+# Dedented once at import; build_messages only fills in the placeholders. Only dynamic state goes here.
+USER_TEMPLATE = textwrap.dedent("""
+    Player character (JSON):
+    stats: {stats_block}
+    relationships: {relationships_block}
+    inventory: {inventory_block}
 
-    Recent history (most recent first):
+    Recent history (oldest first):
     {history_block}
 
-    The player's most recent input (either a choice label exactly as shown in 'choices' or a free-text custom action):
+    Player input:
     {player_input}
+""").strip()
 
-    If the input exactly matches one of the previous choices, continue that branch. If it is a custom action, interpret it and continue.
-    Remember to respond ONLY with valid JSON as specified by the system prompt.
-    """).strip()
+@lru_cache(maxsize=8)
+def system_prompt_tokens(model: str):
+    """Token count of DM_SYSTEM_PROMPT for `model` (rough chars/4 estimate without tiktoken)."""
+    if tiktoken is not None:
+        try:
+            try:
+                enc = tiktoken.encoding_for_model(model)
+            except KeyError:
+                enc = tiktoken.get_encoding("o200k_base")
+            return len(enc.encode(DM_SYSTEM_PROMPT))
+        except Exception:
+            pass  # encodings are downloaded on first use; fall back when offline
+    return len(DM_SYSTEM_PROMPT) // 4
+
+# Shape of every DM turn. Sent as a (non-strict) structured-output schema to gpt-4o models and checked by schema_error.
+DM_RESPONSE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "narrative": {
+            "type": "string",
+            "description": "A paragraph (2-6 sentences) continuing the story."
+        },
+        "choices": {
+            "type": "array",
+            "items": {"type": "string"},
+            "minItems": 3,
+            "maxItems": 5,
+            "description": "Short, distinct options the player can click next."
+        },
+        "state_updates": {
+            "type": "object",
+            "description": 'Small changes to the player state, e.g. {"relationship_with_Rhys": 1, "hp": -1}; can be empty.'
+        },
+        "scene_id": {
+            "type": "string",
+            "description": "A short identifier for the scene."
+        }
+    },
+    "required": ["narrative", "choices", "state_updates", "scene_id"],
+    "additionalProperties": False
+}
+# Built once at import instead of per jsonschema.validate() call.
+DM_VALIDATOR = jsonschema.Draft202012Validator(DM_RESPONSE_SCHEMA)
+
+def build_messages(player_input: str, is_custom: bool):
+    """
+    Build Chat API messages with:
+    - system: DM_SYSTEM_PROMPT
+    - user: INSTRUCTION_MESSAGE (static)
+    - user: current context including pc shards & rolling history summary (both from session state) & player input
+    """
+    history_block = "\n".join(st.session_state.history_block_cache) or "None yet."
+
+    user_state = USER_TEMPLATE.format(
+        stats_block=pc_shard_json("pc_stats"),
+        relationships_block=pc_shard_json("pc_relationships"),
+        inventory_block=pc_shard_json("pc_inventory"),
+        history_block=history_block,
+        player_input=player_input,
+    )
 
     messages = [
         {"role": "system", "content": DM_SYSTEM_PROMPT},
-        {"role": "user", "content": user_instructions},
+        {"role": "user", "content": INSTRUCTION_MESSAGE},
+        {"role": "user", "content": user_state},
     ]
     return messages
 
 ####################
 # LLM interaction  #
 ####################
-def call_llm(messages: List[Dict], model: str, temperature: float, max_tokens: int):
-    openai.api_key = st.session_state.openai_api_key
+# Matches the (possibly still unterminated) "narrative" string of a streamed response.
+_NARRATIVE_RE = re.compile(r'"narrative"\s*:\s*"((?:[^"\\]|\\.)*)')
+
+def extract_partial_narrative(buffer: str):
+    # Permissive: the JSON is usually incomplete while streaming, so only pull out the prose.
+    m = _NARRATIVE_RE.search(buffer)
+    if m is None:
+        return None
+    raw = m.group(1)
     try:
-        resp = openai.ChatCompletion.create(
-            model=model,
-            messages=messages,
-            temperature=temperature,
-            max_tokens=max_tokens,
-            n=1
-        )
-        text = resp["choices"][0]["message"]["content"]
-        return text
+        return orjson.loads(f'"{raw}"')
+    except Exception:
+        return raw  # a half-received escape such as \u20
+
+@st.cache_resource
+def get_client(api_key: str):
+    # One client per key: reruns reuse its HTTP connection pool instead of reconnecting each turn.
+    # The SDK's own retries are off; create_with_retry owns the (bounded) retry policy.
+    return openai.OpenAI(api_key=api_key, max_retries=0)
+
+LLM_ATTEMPTS = 3
+# Transient failures worth retrying: 429, 5xx, and connection errors/timeouts.
+_RETRYABLE_ERRORS = (openai.RateLimitError, openai.InternalServerError, openai.APIConnectionError)
+
+class RetriesExhausted(Exception):
+    """create_with_retry gave up; the last transient error is the __cause__."""
+
+def create_with_retry(client, on_retry=None, **kwargs):
+    """client.chat.completions.create with exponential backoff, at most LLM_ATTEMPTS tries."""
+    for attempt in range(LLM_ATTEMPTS):
+        try:
+            return client.chat.completions.create(**kwargs)
+        except _RETRYABLE_ERRORS as e:
+            if attempt == LLM_ATTEMPTS - 1:
+                raise RetriesExhausted(str(e)) from e
+            delay = 0.5 * 2 ** attempt + random.random() * 0.1
+            if on_retry is not None:
+                on_retry(e, attempt + 1, delay)
+            time.sleep(delay)
+
+def toast_retry(error, attempt: int, delay: float):
+    # A toast, unlike st.error, leaves the page as is while we wait out a transient fault.
+    st.toast(f"OpenAI hiccup ({type(error).__name__}); retrying in {delay:.1f}s (attempt {attempt + 1}/{LLM_ATTEMPTS})")
+
+def stream_llm(messages: List[Dict], model: str, temperature: float, max_tokens: int, client=None, on_retry=None):
+    """Yield content deltas from a streamed chat completion as they arrive."""
+    # Worker threads have no session state, so they pass in a client resolved on the script thread.
+    if client is None:
+        client = get_client(st.session_state.openai_api_key)
+    extra = {}
+    if model.startswith("gpt-4o"):
+        # Non-strict structured outputs: schema adherence is best-effort, so schema_error still checks each turn.
+        extra["response_format"] = {
+            "type": "json_schema",
+            "json_schema": {"name": "dm_turn", "schema": DM_RESPONSE_SCHEMA}
+        }
+    # Only opening the stream is retried; a failure mid-stream would otherwise repeat yielded text.
+    resp = create_with_retry(
+        client,
+        on_retry,
+        model=model,
+        messages=messages,
+        temperature=temperature,
+        max_tokens=max_tokens,
+        n=1,
+        stream=True,
+        **extra
+    )
+    for chunk in resp:
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta.content
+        if delta:
+            yield delta
+
+# At or below this temperature responses are near-deterministic, so identical prompts are served from cache.
+CACHE_MAX_TEMPERATURE = 0.2
+
+@st.cache_data(ttl=3600, max_entries=256, show_spinner=False)
+def _cached_call(messages_json: str, model: str, temperature: float, max_tokens: int, key_fingerprint: str) -> str:
+    # The cache is process-wide: key_fingerprint keeps one API key's responses from being served to another.
+    return "".join(stream_llm(orjson.loads(messages_json), model, temperature, max_tokens))
+
+def key_fingerprint(api_key: str):
+    return hashlib.sha256(api_key.encode()).hexdigest()
+
+def call_llm(messages: List[Dict], model: str, temperature: float, max_tokens: int, placeholder=None):
+    """
+    Stream a completion and return the full text once the stream closes.
+    If a placeholder (st.empty()) is given, the narrative is rendered into it as it arrives.
+    Low-temperature calls are memoized on messages + params and skip the network on a repeat.
+    """
+    buffer = ""
+    try:
+        if temperature <= CACHE_MAX_TEMPERATURE:
+            return _cached_call(orjson.dumps(messages).decode(), model, temperature, max_tokens,
+                                key_fingerprint(st.session_state.openai_api_key))
+        for i, delta in enumerate(stream_llm(messages, model, temperature, max_tokens, on_retry=toast_retry)):
+            buffer += delta
+            if placeholder is not None and i % 4 == 0:
+                preview = extract_partial_narrative(buffer)
+                if preview:
+                    placeholder.markdown(preview)
+        return buffer
+    except RetriesExhausted as e:
+        st.error(f"OpenAI API still failing after {LLM_ATTEMPTS} attempts: {e}")
+        return None
     except Exception as e:
         st.error(f"OpenAI API error: {e}")
         return None
 
+@st.cache_resource
+def get_prefetch_pool():
+    # One pool for the process: max_workers bounds concurrent speculative calls to respect rate limits.
+    return ThreadPoolExecutor(max_workers=PREFETCH_WORKERS, thread_name_prefix="prefetch")
+
+def _request_key(messages: List[Dict], model: str, temperature: float, max_tokens: int):
+    return (orjson.dumps(messages), model, temperature, max_tokens)
+
+def _fetch_completion(client, messages: List[Dict], model: str, temperature: float, max_tokens: int) -> str:
+    return "".join(stream_llm(messages, model, temperature, max_tokens, client=client))
+
+def start_prefetch(choices: List[str]):
+    """Request the next scene for the top choices in the background while the player reads."""
+    pending = st.session_state.prefetch
+    client = get_client(st.session_state.openai_api_key)
+    model = st.session_state.model_quality
+    temperature = st.session_state.temperature
+    max_tokens = st.session_state.max_tokens
+    wanted = {}
+    for choice in choices[:PREFETCH_TOP_N]:
+        messages = build_messages(choice, is_custom=False)
+        wanted[_request_key(messages, model, temperature, max_tokens)] = messages
+    # Requests made under earlier settings (model, temperature, max tokens) can no longer be used.
+    for key in [key for key in pending if key not in wanted]:
+        pending.pop(key).cancel()
+    for key, messages in wanted.items():
+        if key not in pending:
+            pending[key] = get_prefetch_pool().submit(_fetch_completion, client, messages, model, temperature, max_tokens)
+
+def take_prefetched(messages: List[Dict], model: str, temperature: float, max_tokens: int):
+    """Raw text of a prefetch for exactly this request (waiting if already running), or None."""
+    future = st.session_state.prefetch.pop(_request_key(messages, model, temperature, max_tokens), None)
+    if future is None or future.cancel():
+        # Still queued behind other sessions' prefetches: a normal streamed call shows text sooner.
+        return None
+    try:
+        if future.done():
+            return future.result()
+        with st.spinner("The next scene is almost ready…"):
+            return future.result()
+    except Exception:
+        return None  # the caller falls back to a normal call
+
+def clear_prefetch():
+    for future in st.session_state.prefetch.values():
+        future.cancel()  # only stops requests that have not started yet
+    st.session_state.prefetch = {}
+
+# Compiled once: markdown code fences around the JSON, and the outermost {...} span.
+_FENCE_RE = re.compile(r"^```(?:json)?\s*\n?|\n?```\s*$", re.MULTILINE)
+_JSON_OBJ_RE = re.compile(r"\{.*\}", re.DOTALL)
+
 def parse_llm_json(text: str):
-    # LLM instructed to return only JSON. But sometimes it wraps in markdown or adds stray text.
-    # Attempt to locate the first `{` and parse JSON from that.
+    # Structured outputs usually return a bare object, so the direct parse is the normal path.
     try:
-        start = text.index("{")
-        json_text = text[start:]
-        parsed = json.loads(json_text)
-        return parsed
-    except Exception as e:
-        # Fallback try: strip markdown fences
-        cleaned = text.strip().strip("```").strip()
-        try:
-            parsed = json.loads(cleaned)
-            return parsed
-        except Exception as e2:
-            return None
+        return orjson.loads(text)
+    except orjson.JSONDecodeError:
+        pass
+    # Defensive fallback for models without JSON mode: they sometimes wrap in markdown or add stray text.
+    cleaned = _FENCE_RE.sub("", text).strip()
+    try:
+        return orjson.loads(cleaned)
+    except orjson.JSONDecodeError:
+        pass
+    m = _JSON_OBJ_RE.search(cleaned)
+    if m is None:
+        return None
+    try:
+        return orjson.loads(m.group(0))
+    except orjson.JSONDecodeError:
+        return None
+
+def schema_error(parsed):
+    """Message for the most relevant DM_RESPONSE_SCHEMA violation in `parsed`, or None if it is valid."""
+    error = jsonschema.exceptions.best_match(DM_VALIDATOR.iter_errors(parsed))
+    return None if error is None else error.message
 
 ####################
 # Story functions  #
 ####################
+OPENING_PROMPT = "Begin the adventure with a twilight border scene: the protagonist approaches a glittering fae court border. Provide narrative and 3 choices."
+
+def generate_opening_scene():
+    """Ask the LLM for the opening scene. Returns True once current_scene is populated."""
+    messages = build_messages(OPENING_PROMPT, is_custom=True)
+    placeholder = st.empty()
+    # Low-stakes scene-setting: route to the fast model.
+    raw = call_llm(messages, st.session_state.model_fast, st.session_state.temperature, st.session_state.max_tokens,
+                   placeholder=placeholder)
+    placeholder.empty()
+    if raw is None:
+        st.error("Failed to get opening scene from LLM.")
+        return False
+    parsed = parse_llm_json(raw)
+    if parsed is None:
+        st.error("Failed to parse LLM output for opening scene. Raw output shown:")
+        st.code(raw)
+        return False
+    error = schema_error(parsed)
+    if error:
+        st.error(f"LLM output for opening scene does not match the DM schema: {error}")
+        st.code(raw)
+        return False
+    push_history(make_history_entry(parsed, "", raw))
+    return True
+
+def rerun_story(full: bool = False):
+    # A fragment-scoped rerun is only allowed while the fragment itself is rerunning
+    # (not when it runs as part of a full script run), so fall back to a full rerun then.
+    if not full:
+        try:
+            st.rerun(scope="fragment")
+        except StreamlitAPIException:
+            pass
+    st.rerun()
+
 def start_new_adventure():
-    # Reset story history
-    st.session_state.story_history = []
-    st.session_state.current_scene = {
-        "scene_id": "prologue_01",
-        "narrative": f"{st.session_state.pc['name']} arrives at the border of a glittering fae court as twilight bleeds across the sky."
-    }
-    # We will call LLM for the next "real" scene after the player's initial choice.
-    st.experimental_rerun()
+    reset_history()
+    # Fetch the opening scene in the same run as character creation (no extra click + rerun).
+    # On failure we fall through to the "Begin Adventure" fallback with the error still visible.
+    if generate_opening_scene():
+        st.rerun()
 
 def take_choice(choice_text: str, is_custom=False):
-    pc = st.session_state.pc
-    history = st.session_state.story_history
-    messages = build_messages(pc, history, choice_text, is_custom)
-    raw = call_llm(messages, st.session_state.model, st.session_state.temperature, st.session_state.max_tokens)
+    messages = build_messages(choice_text, is_custom)
+    model, temperature, max_tokens = st.session_state.model_quality, st.session_state.temperature, st.session_state.max_tokens
+    raw = take_prefetched(messages, model, temperature, max_tokens)
+    if raw is None:
+        placeholder = st.empty()
+        raw = call_llm(messages, model, temperature, max_tokens, placeholder=placeholder)
+        placeholder.empty()
     if raw is None:
         st.error("No response from LLM.")
         return
@@ -150,26 +557,16 @@ def take_choice(choice_text: str, is_custom=False):
         st.error("Failed to parse LLM output as JSON. Raw output:")
         st.code(raw)
         return
+    error = schema_error(parsed)
+    if error:
+        st.error(f"LLM output does not match the DM schema: {error}")
+        st.code(raw)
+        return
     # Apply state updates if any
-    updates = parsed.get("state_updates") or {}
-    for k, v in updates.items():
-        # simple numeric updates
-        if isinstance(v, (int, float)):
-            st.session_state.pc[k] = st.session_state.pc.get(k, 0) + v
-        else:
-            st.session_state.pc[k] = v
-    # Push to history
-    history_entry = {
-        "scene_id": parsed.get("scene_id"),
-        "narrative": parsed.get("narrative"),
-        "choices": parsed.get("choices"),
-        "choice_taken": choice_text,
-        "raw_llm": raw
-    }
-    st.session_state.story_history.append(history_entry)
-    st.session_state.current_scene = history_entry
-    # Rerun to update UI
-    st.experimental_rerun()
+    pc_changed = apply_state_updates(parsed.get("state_updates") or {})
+    push_history(make_history_entry(parsed, choice_text, raw))
+    # Rerun to update UI: just the story panel, unless the character card (HP, inventory, ...) is stale too
+    rerun_story(full=pc_changed)
 
 ####################
 # UI Layout         #
@@ -186,84 +583,36 @@ with col2:
         type="password", 
         value=st.session_state.openai_api_key
     )
-    st.session_state.model = st.selectbox("Model", options=["gpt-4o-mini", "gpt-4o", "gpt-4o-mid"], index=0)
+    st.session_state.model_quality = st.selectbox("Story model", options=MODEL_OPTIONS, index=MODEL_OPTIONS.index(st.session_state.model_quality))
+    st.session_state.model_fast = st.selectbox("Fast model (opening scene)", options=MODEL_OPTIONS, index=MODEL_OPTIONS.index(st.session_state.model_fast))
     st.session_state.temperature = st.slider("Temperature", 0.0, 1.5, st.session_state.temperature, 0.05)
     st.session_state.max_tokens = st.number_input("Max tokens (response)", min_value=120, max_value=2000, value=st.session_state.max_tokens, step=10)
+    st.caption(f"System prompt: ~{system_prompt_tokens(st.session_state.model_quality)} tokens per request")
+    st.session_state.prefetch_enabled = st.checkbox(
+        f"Prefetch next scene for the first {PREFETCH_TOP_N} choices (extra API calls)",
+        value=st.session_state.prefetch_enabled
+    )
+    st.session_state.debug_raw = st.checkbox("Keep raw LLM output in history (debug)", value=st.session_state.debug_raw)
     st.markdown("---")
     st.markdown("**Session quick-controls**")
     if st.button("Restart session (clear story)"):
-        st.session_state.story_history = []
-        st.session_state.current_scene = None
-        st.experimental_rerun()
-
-with col1:
-    # Character creation / summary
-    if st.session_state.pc is None:
-        st.header("Create your character")
-        with st.form("pc_form"):
-            name = st.text_input("Name", value="Aryn")
-            court = st.selectbox("Court Affiliation", ["Night Court (mysterious)", "Dawn Court (stately)", "Spring Court (warmth)", "Autumn Court (wary)", "Independent / None"])
-            archetype = st.selectbox("Archetype", ["Wary Survivor", "Scholarly Heir", "Ambitious Outsider", "Reckless Champion"])
-            strength = st.slider("Strength (physical prowess)", 1, 10, 5)
-            guile = st.slider("Guile (social skill / stealth)", 1, 10, 6)
-            magic = st.slider("Magic affinity", 0, 10, 3)
-            submit = st.form_submit_button("Create & Start Adventure")
-        if submit:
-            st.session_state.pc = {
-                "name": name,
-                "court": court,
-                "archetype": archetype,
-                "strength": strength,
-                "guile": guile,
-                "magic": magic,
-                "hp": 10,
-                "relationship": {},
-                "inventory": []
-            }
-            start_new_adventure()
-        else:
-            st.info("Fill in the form and press 'Create & Start Adventure' to begin.")
-            st.stop()
-    else:
-        # Show PC summary
-        pc = st.session_state.pc
-        st.header(f"Player: {pc['name']} — {pc['court']}")
-        colpc1, colpc2, colpc3 = st.columns(3)
-        colpc1.metric("Strength", pc.get("strength", 0))
-        colpc2.metric("Guile", pc.get("guile", 0))
-        colpc3.metric("Magic", pc.get("magic", 0))
-        st.write("HP:", pc.get("hp"))
-        st.write("Inventory:", ", ".join(pc.get("inventory", []) or ["—"]))
-        st.markdown("---")
+        reset_history()
+        st.rerun()
 
+@st.fragment
+def story_panel():
+    """
+    Story column body. Its buttons and forms rerun only this fragment, so the
+    settings panel and character card are not rebuilt on every click.
+    """
     # Current scene / story area
     st.subheader("Story")
     if st.session_state.current_scene is None:
         st.write("The world waits. Press **Begin** to ask the Narrative Engine for the opening scene.")
+        # Fallback only: character creation already requests the opening scene (e.g. after a restart).
         if st.button("Begin Adventure"):
-            # Fire off a special "start" prompt that seeds the prologue
-            # Use the current pc and an initial prompt like "open with a twilight border scene"
-            start_prompt = "Begin the adventure with a twilight border scene: the protagonist approaches a glittering fae court border. Provide narrative and 3 choices."
-            messages = build_messages(st.session_state.pc, st.session_state.story_history, start_prompt, is_custom=True)
-            raw = call_llm(messages, st.session_state.model, st.session_state.temperature, st.session_state.max_tokens)
-            if raw is None:
-                st.error("Failed to get opening scene from LLM.")
-            else:
-                parsed = parse_llm_json(raw)
-                if parsed is None:
-                    st.error("Failed to parse LLM output for opening scene. Raw output shown:")
-                    st.code(raw)
-                else:
-                    entry = {
-                        "scene_id": parsed.get("scene_id"),
-                        "narrative": parsed.get("narrative"),
-                        "choices": parsed.get("choices"),
-                        "choice_taken": "",
-                        "raw_llm": raw
-                    }
-                    st.session_state.story_history.append(entry)
-                    st.session_state.current_scene = entry
-                    st.experimental_rerun()
+            if generate_opening_scene():
+                rerun_story()
         st.stop()
     else:
         scene = st.session_state.current_scene
@@ -272,7 +621,7 @@ with col1:
 
         # Show history / breadcrumbs
         with st.expander("History (recent)"):
-            for i, h in enumerate(reversed(st.session_state.story_history[-10:])):
+            for h in reversed(st.session_state.recent_history):
                 st.markdown(f"**{h.get('scene_id','?')}** — {h.get('choice_taken','(start)')}")
                 st.write(h.get("narrative"))
 
@@ -285,6 +634,8 @@ with col1:
             for i, choice in enumerate(choices):
                 if cols[i].button(choice):
                     take_choice(choice, is_custom=False)
+            if st.session_state.prefetch_enabled and st.session_state.openai_api_key:
+                start_prefetch(choices)
         else:
             st.info("No choices in this scene. You may type a custom action.")
 
@@ -299,18 +650,60 @@ with col1:
         st.markdown("---")
         st.subheader("Quick tools")
         if st.button("Show raw LLM JSON for this scene"):
-            st.code(pretty_json({
-                "scene_id": scene.get("scene_id"),
-                "narrative": scene.get("narrative"),
-                "choices": scene.get("choices")
-            }))
-
-        if st.button("Export story (JSON)"):
-            export = {
-                "player": st.session_state.pc,
-                "history": st.session_state.story_history
+            if scene.get("raw_llm"):
+                # full response incl. state_updates (only kept with the debug setting on)
+                st.code(pretty_json(parse_llm_json(scene["raw_llm"])))
+            else:
+                st.code(pretty_json({
+                    "scene_id": scene.get("scene_id"),
+                    "narrative": scene.get("narrative"),
+                    "choices": scene.get("choices")
+                }))
+
+        st.download_button("Download story JSON", data=export_json(), file_name="adventure_export.json", mime="application/json")
+
+with col1:
+    # Character creation / summary
+    if st.session_state.pc_stats is None:
+        st.header("Create your character")
+        with st.form("pc_form"):
+            name = st.text_input("Name", value="Aryn")
+            court = st.selectbox("Court Affiliation", ["Night Court (mysterious)", "Dawn Court (stately)", "Spring Court (warmth)", "Autumn Court (wary)", "Independent / None"])
+            archetype = st.selectbox("Archetype", ["Wary Survivor", "Scholarly Heir", "Ambitious Outsider", "Reckless Champion"])
+            strength = st.slider("Strength (physical prowess)", 1, 10, 5)
+            guile = st.slider("Guile (social skill / stealth)", 1, 10, 6)
+            magic = st.slider("Magic affinity", 0, 10, 3)
+            submit = st.form_submit_button("Create & Start Adventure")
+        if submit:
+            st.session_state.pc_stats = {
+                "name": name,
+                "court": court,
+                "archetype": archetype,
+                "strength": strength,
+                "guile": guile,
+                "magic": magic,
+                "hp": 10
             }
-            st.download_button("Download story JSON", data=json.dumps(export, ensure_ascii=False, indent=2), file_name="adventure_export.json", mime="application/json")
+            st.session_state.pc_relationships = {}
+            st.session_state.pc_inventory = []
+            mark_pc_dirty(*PC_SHARDS)
+            start_new_adventure()
+        else:
+            st.info("Fill in the form and press 'Create & Start Adventure' to begin.")
+            st.stop()
+    else:
+        # Show PC summary
+        pc = pc_view()
+        st.header(f"Player: {pc['name']} — {pc['court']}")
+        colpc1, colpc2, colpc3 = st.columns(3)
+        colpc1.metric("Strength", pc.get("strength", 0))
+        colpc2.metric("Guile", pc.get("guile", 0))
+        colpc3.metric("Magic", pc.get("magic", 0))
+        st.write("HP:", pc.get("hp"))
+        st.write("Inventory:", ", ".join(str(item) for item in pc.get("inventory", [])) or "—")
+        st.markdown("---")
+
+    story_panel()
 
 # Footer
 st.markdown("---")